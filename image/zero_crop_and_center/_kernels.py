@@ -0,0 +1,213 @@
+# Numba-compiled kernels for zero_crop_and_center.py
+#
+# zero_crop_and_center.py uses these when numba is installed and
+# falls back to the NumPy implementations otherwise.
+#
+# All kernels are compiled with cache=True, so the machine code is
+# kept in __pycache__ and only the first run after a change to this
+# file pays for compiling it.
+
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _row_has_foreground(img, row, thr):
+    for col in range(img.shape[1]):
+        if img[row, col] > thr:
+            return True
+    return False
+
+
+@numba.njit(cache=True, boundscheck=False)
+def bounding_box(img, thr):
+    """Same as `find_zero_bounding_box`, but stops scanning each
+    edge at the first pixel above `thr`."""
+    height, width = img.shape
+
+    # crop top
+    start_row = 0
+    while start_row < height and not _row_has_foreground(img, start_row, thr):
+        start_row += 1
+
+    # nothing but background, nothing to crop to
+    if start_row == height:
+        return 0, 0, 0, 0
+
+    # crop bottom
+    end_row = height
+    while not _row_has_foreground(img, end_row - 1, thr):
+        end_row -= 1
+
+    # crop left and right, only looking at the rows that were kept;
+    # walking along rows keeps the reads contiguous, and each row is
+    # only scanned up to the bounds found so far
+    start_col, end_col = width, 0
+    for row in range(start_row, end_row):
+        for col in range(start_col):
+            if img[row, col] > thr:
+                start_col = col
+                break
+        for col in range(width - 1, end_col - 1, -1):
+            if img[row, col] > thr:
+                end_col = col + 1
+                break
+
+    return start_row, end_row, start_col, end_col
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _center_of_mass(img, start_row, end_row, start_col, end_col):
+    # integer moments; each row is summed first so that the y moment
+    # needs one multiplication per row instead of one per pixel
+    total = np.int64(0)
+    y_moment = np.int64(0)
+    x_moment = np.int64(0)
+    for row in range(start_row, end_row):
+        row_total = np.int64(0)
+        for col in range(start_col, end_col):
+            value = img[row, col]
+            row_total += value
+            x_moment += value * (col - start_col)
+        total += row_total
+        y_moment += row_total * (row - start_row)
+
+    if total == 0:
+        return 0, 0
+    return y_moment // total, x_moment // total
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _nonzero_row_span(img):
+    """Returns the (start, end) range of rows of the C-contiguous uint8
+    `img` outside of which all pixels are zero.
+
+    The image is read as 64-bit words from both ends, testing eight
+    pixels per comparison, and the scans stop at the first nonzero
+    word. Returns (0, 0) for an all-zero image.
+
+    `img` must start on an 8-byte boundary for the 64-bit view, which
+    numpy's allocations and the image stacks of zero_crop_and_center.py
+    (padded to a multiple of 8 pixels per row) guarantee."""
+    width = img.shape[1]
+    flat = img.reshape(img.size)
+    n_words = flat.size // 8
+    words = flat[:n_words * 8].view(np.uint64)
+
+    first = 0
+    while first < n_words and words[first] == 0:
+        first += 1
+    start = first * 8
+
+    # the last few pixels may not fill a whole word
+    stop = flat.size
+    while stop > n_words * 8 and flat[stop - 1] == 0:
+        stop -= 1
+    if stop == n_words * 8:
+        last = n_words
+        while last > first and words[last - 1] == 0:
+            last -= 1
+        stop = last * 8
+
+    if stop <= start:
+        return 0, 0
+    return start // width, (stop - 1) // width + 1
+
+
+# The signatures below compile these kernels when the module is
+# imported (or load them from the cache) instead of on their first
+# call. They only accept C-contiguous uint8 images, which is what
+# zero_crop_and_center.py stages the decoded PNGs into.
+
+
+@numba.njit('void(uint8[:, ::1], uint8[:, ::1], int64, int64[::1])',
+            cache=True, boundscheck=False)
+def crop_and_center(img, out, thr, extent):
+    """Crops `img` to its bounding box and pastes the crop into `out`,
+    centered on its center of mass.
+
+    `out` is reused across calls: `extent` holds (y0, x0, height,
+    width) of the previous paste, which is the only region of `out`
+    that gets zeroed, and receives the extent of the new one. Crops
+    that do not fit into `out` are not pasted.
+
+    The bounding box and the moments are collected in a single pass
+    over `img` (plus one over the crop if `thr != 0`). For `thr == 0`,
+    leading and trailing zero rows are skipped one 64-bit word at a
+    time first, which requires `img` to be 8-byte aligned."""
+    img_height, img_width = img.shape
+    out_height, out_width = out.shape
+
+    y0, x0, height, width = extent[0], extent[1], extent[2], extent[3]
+    out[y0:y0 + height, x0:x0 + width] = 0
+    extent[:] = 0
+
+    start_row, end_row = img_height, -1
+    start_col, end_col = img_width, -1
+    total = np.int64(0)
+    y_moment = np.int64(0)
+    x_moment = np.int64(0)
+    first_row, last_row = 0, img_height
+    if thr == 0:
+        first_row, last_row = _nonzero_row_span(img)
+
+    for row in range(first_row, last_row):
+        row_total = np.int64(0)
+        for col in range(img_width):
+            value = img[row, col]
+            if value > thr:
+                if row < start_row:
+                    start_row = row
+                end_row = row
+                if col < start_col:
+                    start_col = col
+                if col > end_col:
+                    end_col = col
+            row_total += value
+            x_moment += value * col
+        total += row_total
+        y_moment += row_total * row
+
+    # nothing but background, nothing to paste
+    if end_row < 0:
+        return
+
+    end_row += 1
+    end_col += 1
+    height = end_row - start_row
+    width = end_col - start_col
+    extent[2] = height
+    extent[3] = width
+    if height >= out_height or width >= out_width:
+        return
+
+    if thr == 0:
+        # all pixels outside of the crop are zero and the crop holds at
+        # least one nonzero pixel, so `total` is positive here
+        y_center = y_moment // total - start_row
+        x_center = x_moment // total - start_col
+    else:
+        # for thr > 0, faint pixels outside of the crop must not pull on
+        # the center; for thr < 0, the crop may hold only zeros
+        y_center, x_center = _center_of_mass(img, start_row, end_row,
+                                             start_col, end_col)
+
+    y0 = min(max(0, out_height // 2 - y_center), out_height - height)
+    x0 = min(max(0, out_width // 2 - x_center), out_width - width)
+    out[y0:y0 + height, x0:x0 + width] = \
+        img[start_row:end_row, start_col:end_col]
+    extent[0] = y0
+    extent[1] = x0
+
+
+@numba.njit('void(uint8[:, :, ::1], uint8[:, :, ::1], int64[:, ::1], int64)',
+            parallel=True, cache=True, boundscheck=False)
+def process_batch(images, out, extents, thr):
+    """Runs `crop_and_center` on every image of the (N, H, W) `images`
+    stack, writing into the (N, out_height, out_width) `out` stack.
+
+    `extents[k]` must hold the previous extent pasted into `out[k]`
+    (zeros for a fresh buffer) and receives the new one; the caller
+    is expected to check `extents[k, 2:]` against the output size."""
+    for k in numba.prange(images.shape[0]):
+        crop_and_center(images[k], out[k], thr, extents[k])
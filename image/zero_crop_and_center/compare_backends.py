@@ -0,0 +1,74 @@
+# Checks that the NumPy and the Numba code paths of
+# zero_crop_and_center.py produce the same images:
+#
+#     python compare_backends.py
+#
+# At the default threshold of 0, both are compared against the
+# reference outputs in some_mnist_out/ (created with
+# `--out_height 28 --out_width 28`); at a positive threshold, against
+# each other.
+
+import os
+import numpy as np
+import imageio
+
+import zero_crop_and_center as zcc
+
+
+def _load(directory, names):
+    return [imageio.imread(os.path.join(directory, name)) for name in names]
+
+
+def _run(images, output_size, background_threshold, kernels):
+    # `_kernels = None` makes zero_crop_and_center.py take the NumPy path
+    zcc._kernels = kernels
+    out = np.zeros((len(images),) + output_size, dtype=np.uint8)
+    extents = np.zeros((len(images), 4), dtype=np.int64)
+    staging = None
+    if zcc._uses_batch_kernel(background_threshold):
+        staged_shapes = np.zeros((len(images), 2), dtype=np.int64)
+        staging = zcc._stage_images(images, staging, staged_shapes)
+    zcc._crop_and_center_all(images, staging, out, extents,
+                             background_threshold)
+    return out
+
+
+def _report(label, got, expected, names):
+    mismatches = [name for name, a, b in zip(names, got, expected)
+                  if not np.array_equal(a, b)]
+    print(f'{label}: {len(names) - len(mismatches)}/{len(names)} identical')
+    for name in mismatches:
+        print(f'  differs: {name}')
+    return not mismatches
+
+
+if __name__ == '__main__':
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    names = sorted(name for name in os.listdir(os.path.join(here,
+                                                            'some_mnist'))
+                   if name.endswith('.png'))
+    images = _load(os.path.join(here, 'some_mnist'), names)
+    reference = np.stack(_load(os.path.join(here, 'some_mnist_out'), names))
+    output_size = reference.shape[1:]
+
+    kernels = zcc._kernels
+    if kernels is None:
+        print('numba is not installed, only checking the NumPy path')
+
+    ok = True
+    numpy_out = _run(images, output_size, 0, None)
+    ok &= _report('NumPy, threshold 0 vs. reference',
+                  numpy_out, reference, names)
+    if kernels is not None:
+        numba_out = _run(images, output_size, 0, kernels)
+        ok &= _report('Numba, threshold 0 vs. reference',
+                      numba_out, reference, names)
+
+        numpy_out = _run(images, output_size, 64, None)
+        numba_out = _run(images, output_size, 64, kernels)
+        ok &= _report('Numba vs. NumPy, threshold 64',
+                      numba_out, numpy_out, names)
+
+    zcc._kernels = kernels
+    raise SystemExit(0 if ok else 1)
@@ -9,10 +9,29 @@
 
 import os
 import argparse
+import collections
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import imageio
-from scipy.ndimage.measurements import center_of_mass
-import math
+
+try:
+    import cv2
+except ImportError:  # fall back to imageio for reading and writing
+    cv2 = None
+
+try:
+    import _kernels
+except ImportError:  # numba is not installed
+    _kernels = None
+
+
+def _mask_extent(mask):
+    # `mask[::-1]` is a negative-stride view, so finding the last True
+    # entry does not copy the mask (unlike `np.flip(...).copy()` or
+    # iterating over a transposed image)
+    return int(mask.argmax()), len(mask) - int(mask[::-1].argmax())
 
 
 def find_zero_bounding_box(image_array, background_threshold=0):
@@ -21,60 +40,73 @@ def find_zero_bounding_box(image_array, background_threshold=0):
         raise ValueError(f'Only 2D arrays are supported.\n'
                          f'Got {len(image_array.shape)} array.')
 
-    # crop top
-    start_row = 0
-    keep_row = False
-    for row in image_array:
-        if keep_row:
-            break
+    if _kernels is not None:
+        return _kernels.bounding_box(image_array, background_threshold)
 
-        for ele in row:
-            if ele > background_threshold:
-                keep_row = True
-                break
-        if not keep_row:
-            start_row += 1
-
-    # crop bottom
-    end_row = image_array.shape[0]-1
-    keep_row = False
-    for row in np.flip(image_array, axis=0):
-        if keep_row:
-            break
-        for ele in row:
-            if ele > background_threshold:
-                keep_row = True
-                break
-        if not keep_row:
-            end_row -= 1
-
-    # crop left
-    start_col = 0
-    keep_row = False
-    for row in image_array.T:
-        if keep_row:
-            break
-        for ele in row:
-            if ele > background_threshold:
-                keep_row = True
-                break
-        if not keep_row:
-            start_col += 1
-
-    # crop right
-    end_col = image_array.shape[0]-1
-    keep_row = False
-    for row in np.flip(image_array.T, axis=0):
-        if keep_row:
-            break
-        for ele in row:
-            if ele > background_threshold:
-                keep_row = True
-                break
-        if not keep_row:
-            end_col -= 1
+    if background_threshold == 0 and image_array.dtype.kind in 'ub':
+        # for unsigned pixels "> 0" is "!= 0", so the image can be
+        # reduced directly without building a boolean mask first
+        row_mask = image_array.any(axis=1)
+        col_mask = image_array.any(axis=0)
+    else:
+        mask = image_array > background_threshold
+        row_mask = mask.any(axis=1)
+        col_mask = mask.any(axis=0)
+
+    # nothing but background, nothing to crop to
+    if not row_mask.any():
+        return 0, 0, 0, 0
+
+    start_row, end_row = _mask_extent(row_mask)
+    start_col, end_col = _mask_extent(col_mask)
+
+    return start_row, end_row, start_col, end_col
+
+
+def _check_fits(image_shape, output_shape):
+
+    if output_shape[0] <= image_shape[0]:
+        raise ValueError(f'Output array must not be taller than input array.\n'
+                         f'Got {image_shape[0]} '
+                         f'and {output_shape[0]}.')
+
+    if output_shape[1] <= image_shape[1]:
+        raise ValueError(f'Output array must not be wider than input array.\n'
+                         f'Got {image_shape[1]} '
+                         f'and {output_shape[1]}.')
+
+
+def _paste_centered(image_array, output_array, index=None):
+    """Pastes `image_array` into the blank region of `output_array`,
+    centered on its center of mass, and returns the top-left corner
+    of the pasted region.
+
+    `index` is an `np.arange` at least as long as either side of
+    `image_array`; pass one in to reuse it across images."""
+    height, width = image_array.shape
+    if index is None:
+        index = np.arange(max(height, width), dtype=np.int64)
+
+    # center of mass from the row and column marginals
+    row_sum = image_array.sum(axis=1, dtype=np.int64)
+    col_sum = image_array.sum(axis=0, dtype=np.int64)
+    total = row_sum.sum()
+    if total:
+        y_center = int(np.dot(row_sum, index[:height]) // total)
+        x_center = int(np.dot(col_sum, index[:width]) // total)
+    else:
+        y_center, x_center = 0, 0
+
+    # shift the crop back inside if centering pushed it over the edge
+    y0 = min(max(0, output_array.shape[0] // 2 - y_center),
+             output_array.shape[0] - height)
+    x0 = min(max(0, output_array.shape[1] // 2 - x_center),
+             output_array.shape[1] - width)
 
-    return start_row, end_row+1, start_col, end_col+1
+    np.copyto(output_array[y0:y0 + height, x0:x0 + width], image_array,
+              casting='unsafe')
+
+    return y0, x0
 
 
 def center_in_image(image_array, output_size):
@@ -89,41 +121,165 @@ def center_in_image(image_array, output_size):
         raise ValueError(f'Only 2D output image arrays are supported.\n'
                          f'Got {len(output_array.shape)} array.')
 
-    if output_array.shape[0] <= image_array.shape[0]:
-        raise ValueError(f'Output array must not be taller than input array.\n'
-                         f'Got {image_array.shape[0]} '
-                         f'and {output_array.shape[0]}.')
-
-    if output_array.shape[1] <= image_array.shape[1]:
-        raise ValueError(f'Output array must not be wider than input array.\n'
-                         f'Got {image_array.shape[1]} '
-                         f'and {output_array.shape[1]}.')
-
-    y_center, x_center = center_of_mass(image_array)
-    y_center, x_center = math.floor(y_center), math.floor(x_center)
-
-    y_center_out = output_array.shape[0] // 2
-    x_center_out = output_array.shape[1] // 2
+    _check_fits(image_array.shape, output_array.shape)
 
-    x_diff = max(0, x_center_out - x_center)
-    y_diff = max(0, y_center_out - y_center)
+    _paste_centered(image_array, output_array)
 
-    y_buff = 0
-    x_buff = 0
-
-    out_shape = output_array[y_diff:image_array.shape[0]+y_diff,
-                             x_diff:image_array.shape[1]+x_diff]
+    return output_array
 
-    if out_shape.shape[0] < image_array.shape[0]:
-        y_buff = image_array.shape[0] - out_shape.shape[0]
 
-    if out_shape.shape[1] < image_array.shape[1]:
-        x_buff = image_array.shape[1] - out_shape.shape[1]
+def _read_image(path, invert=False):
+    if cv2 is not None:
+        # OpenCV's PNG decoder is a good bit faster than imageio's
+        # Pillow backend; IMREAD_UNCHANGED keeps 16-bit data and the
+        # channels like imageio does, and going through np.fromfile
+        # (unlike cv2.imread) also works for non-ASCII paths on Windows
+        img = cv2.imdecode(np.fromfile(path, dtype=np.uint8),
+                           cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError(f'Could not read {path}')
+    else:
+        img = imageio.imread(path)
+    if invert:
+        img = np.invert(img)
+    if len(img.shape) != 2:
+        raise ValueError(f'Only 2D arrays are supported.\n'
+                         f'Got {len(img.shape)} array.')
+    return img
+
+
+def _write_image(path, img):
+    if cv2 is None:
+        imageio.imsave(path, img)
+        return
+    ok, buf = cv2.imencode(os.path.splitext(path)[1], img)
+    if not ok:
+        raise ValueError(f'Could not write {path}')
+    buf.tofile(path)
+
+
+def _prefetch(executor, func, iterable, depth):
+    """Like `executor.map`, but yields the futures and never has more
+    than `depth` of them in flight, which caps the number of decoded
+    images held in memory."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= depth:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def _crop_and_center_one(img, out, extent, background_threshold,
+                         index=None):
+    """NumPy version of `_kernels.crop_and_center` that works on any
+    2D image dtype."""
+    y0, x0, height, width = extent
+    out[y0:y0 + height, x0:x0 + width] = 0
+
+    top, bottom, left, right = find_zero_bounding_box(
+        img, background_threshold)
+    cropped_img = img[top:bottom, left:right]
+    extent[:] = (0, 0) + cropped_img.shape
+    if (cropped_img.size
+            and cropped_img.shape[0] < out.shape[0]
+            and cropped_img.shape[1] < out.shape[1]):
+        extent[:2] = _paste_centered(cropped_img, out, index)
+
+
+def _uses_batch_kernel(background_threshold):
+    # the zero padding of the stacked images is only background for
+    # non-negative thresholds
+    return _kernels is not None and background_threshold >= 0
+
+
+def _stage_images(images, staging, staged_shapes):
+    """Copies `images` into the reusable (N, H, W) uint8 `staging`
+    stack that the kernels are compiled for, growing it when an image
+    does not fit, and returns the stack.
+
+    `staged_shapes[k]` holds the shape of the image previously copied
+    into slot `k`; only its pixels outside of the new image are zeroed.
+    The zero padding is background for non-negative thresholds and
+    does not change the bounding boxes then. Rows are padded to a
+    multiple of 8 pixels, so that every slot starts on the 8-byte
+    boundary `_kernels.crop_and_center` reads 64-bit words from.
+
+    Images that are not uint8 (e.g. 16-bit PNGs) would wrap around
+    when copied, so their slots are left blank and
+    `_crop_and_center_all` hands them to the NumPy path instead."""
+    images = [img if img.dtype == np.uint8 else img[:0, :0]
+              for img in images]
+    height = max(img.shape[0] for img in images)
+    width = max(img.shape[1] for img in images)
+    if (staging is None or height > staging.shape[1]
+            or width > staging.shape[2]):
+        if staging is not None:
+            height = max(height, staging.shape[1])
+            width = max(width, staging.shape[2])
+        staging = np.zeros((len(staged_shapes), height, -(-width // 8) * 8),
+                           dtype=np.uint8)
+        staged_shapes[:] = 0
+
+    for k, img in enumerate(images):
+        height, width = img.shape
+        prev_height, prev_width = staged_shapes[k]
+        staging[k, height:prev_height, :prev_width] = 0
+        staging[k, :height, width:prev_width] = 0
+        staging[k, :height, :width] = img
+        staged_shapes[k] = height, width
+
+    return staging
+
+
+def _crop_and_center_all(images, staging, out, extents,
+                         background_threshold):
+    """Crops and centers `images` into the reusable `out` stack.
+
+    The Numba kernels read the images from `staging`, the stack filled
+    by `_stage_images`; the NumPy fallback ignores it.
+
+    `extents[k]` holds (y0, x0, height, width) of the crop previously
+    pasted into `out[k]` (zeros for a fresh buffer). Only that region
+    is cleared before the new crop is pasted and its extent stored.
+    Crops that do not fit into `out` are not pasted, and all-background
+    images yield an all-zero extent."""
+    if not _uses_batch_kernel(background_threshold):
+        # the crops that get pasted are smaller than the output, so one
+        # index range covers all of them
+        index = np.arange(max(out.shape[1:]), dtype=np.int64)
+        for k, img in enumerate(images):
+            _crop_and_center_one(img, out[k], extents[k],
+                                 background_threshold, index)
+        return
+
+    n = len(images)
+    _kernels.process_batch(staging[:n], out[:n], extents[:n],
+                           background_threshold)
+
+    # the kernel saw blank slots for these and only cleared `out[k]`
+    for k, img in enumerate(images):
+        if img.dtype != np.uint8:
+            _crop_and_center_one(img, out[k], extents[k],
+                                 background_threshold)
+
+
+def _report_writes(writes):
+    for in_img, future in writes:
+        try:
+            future.result()
+        except Exception as e:
+            print(f'Error handling file{in_img}')
+            print(e)
+    writes.clear()
 
-    output_array[y_diff-y_buff:image_array.shape[0]+y_diff,
-                 x_diff-x_buff:image_array.shape[1]+x_diff] = image_array
 
-    return output_array
+# images cropped and centered per call, decoded images kept in
+# flight, and threads used for decoding and for encoding
+_CHUNK_SIZE = 32
+_PREFETCH = 2 * _CHUNK_SIZE
+_IO_WORKERS = 4
 
 
 if __name__ == '__main__':
@@ -174,30 +330,96 @@ python zero_crop_and_center --in_dir './some_pngs'/\\
     if not os.path.exists(args.out_dir):
         os.mkdir(args.out_dir)
 
-    png_names = [i for i in os.listdir(args.in_dir) if i.endswith('.png')]
-    if not len(png_names):
+    with os.scandir(args.in_dir) as it:
+        png_entries = [e for e in it if e.name.endswith('.png')]
+    if not len(png_entries):
         raise ValueError(f'No .png files found in {args.in_dir}')
 
-    in_paths = [os.path.join(args.in_dir, i) for i in png_names]
-    out_paths = [os.path.join(args.out_dir, i) for i in png_names]
-
-    for in_img, out_img in zip(in_paths, out_paths):
-
-        try:
-            img = imageio.imread(in_img)
-            if args.invert_image:
-                img = np.invert(img)
-            top, bottom, left, right = find_zero_bounding_box(
-                img, args.background_threshold)
-            cropped_img = img[top:bottom, left:right]
-
-            centered_img = center_in_image(image_array=img[top:bottom, left:right],
-                                           output_size=(args.out_height,
-                                                        args.out_width))
-
-            imageio.imsave(out_img, centered_img)
-        except Exception as e:
-
-            print(f'Error handling file{in_img}')
-            print(e)
+    in_paths = [e.path for e in png_entries]
+    out_paths = [os.path.join(args.out_dir, e.name) for e in png_entries]
+
+    output_size = (args.out_height, args.out_width)
+
+    # decoding and encoding run in background threads (libpng releases
+    # the GIL) while the main thread crops and centers one chunk of
+    # images at a time
+    with ThreadPoolExecutor(_IO_WORKERS) as reader, \
+            ThreadPoolExecutor(_IO_WORKERS) as writer:
+
+        read_image = functools.partial(_read_image,
+                                       invert=args.invert_image)
+        decoded = zip(in_paths, out_paths,
+                      _prefetch(reader, read_image, in_paths, _PREFETCH))
+
+        # two sets of reusable output buffers: one is filled while the
+        # images in the other one are still being written
+        buffers = [(np.zeros((_CHUNK_SIZE,) + output_size, dtype=np.uint8),
+                    np.zeros((_CHUNK_SIZE, 4), dtype=np.int64))
+                   for _ in range(2)]
+        writes = [[], []]
+        slot = 0
+
+        # reusable uint8 input stack for the Numba kernels
+        staging = None
+        staged_shapes = np.zeros((_CHUNK_SIZE, 2), dtype=np.int64)
+
+        while True:
+            chunk = list(itertools.islice(decoded, _CHUNK_SIZE))
+            if not chunk:
+                break
 
+            images, chunk_paths = [], []
+            for in_img, out_img, future in chunk:
+                try:
+                    images.append(future.result())
+                    chunk_paths.append((in_img, out_img))
+                except Exception as e:
+                    print(f'Error handling file{in_img}')
+                    print(e)
+
+            if not images:
+                continue
+
+            slot = 1 - slot
+            _report_writes(writes[slot])
+            centered, extents = buffers[slot]
+            if _uses_batch_kernel(args.background_threshold):
+                staging = _stage_images(images, staging, staged_shapes)
+            failed = set()
+            try:
+                _crop_and_center_all(images, staging, centered, extents,
+                                     args.background_threshold)
+            except Exception:
+                # redo the chunk one image at a time so that the error
+                # is reported for the file that caused it; the buffers
+                # may hold partial results, so start from scratch
+                centered[:] = 0
+                extents[:] = 0
+                for k, (img, (in_img, _)) in enumerate(zip(images,
+                                                           chunk_paths)):
+                    try:
+                        _crop_and_center_one(img, centered[k], extents[k],
+                                             args.background_threshold)
+                    except Exception as e:
+                        print(f'Error handling file{in_img}')
+                        print(e)
+                        centered[k] = 0
+                        extents[k] = 0
+                        failed.add(k)
+
+            for k, (in_img, out_img) in enumerate(chunk_paths):
+                if k in failed:
+                    continue
+                if not extents[k, 2]:
+                    print(f'Skipping blank image {in_img}')
+                    continue
+                try:
+                    _check_fits(extents[k, 2:], output_size)
+                    writes[slot].append((in_img, writer.submit(
+                        _write_image, out_img, centered[k])))
+                except Exception as e:
+                    print(f'Error handling file{in_img}')
+                    print(e)
+
+        for pending in writes:
+            _report_writes(pending)